@@ -1,135 +1,260 @@
+import argparse
+import base64
 import csv
+import html
+import io
 import os
+import shutil
 import urllib.request
-from reportlab.pdfgen import canvas
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from reportlab.pdfgen import canvas, textobject
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.colors import red
-from pypdf import PdfReader, PdfWriter
+import pikepdf
+from pikepdf import Name
 from playwright.sync_api import sync_playwright
 from PIL import Image
 
 # Configuration
-FONT_URL = "https://github.com/googlefonts/noto-fonts/raw/main/hinted/ttf/NotoSansGujarati/NotoSansGujarati-Bold.ttf"
+# Served directly rather than via github.com/.../raw/..., whose redirect
+# urllib follows as a GET, which would turn the size check into a download
+FONT_URL = "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/hinted/ttf/NotoSansGujarati/NotoSansGujarati-Bold.ttf"
 FONT_FILENAME = "NotoSansGujarati-Bold.ttf"
+# Seconds to wait on the font server before giving up
+FONT_TIMEOUT = 30
 INPUT_PDF = "kankotri.pdf"
 CSV_FILE = "name.csv"
 X_COORD = 208
 Y_COORD = 385
 FONT_SIZE = 14
 TEXT_COLOR = 'red'
+FONT_NAME = 'GujaratiFont'
+# Rasterize the name in headless Chromium instead of drawing shaped vector text.
+# ReportLab only shapes Gujarati when both rlbidi and uharfbuzz are installed;
+# without them this is switched on automatically. Also useful if the shaper
+# gets a ligature wrong.
+USE_BROWSER_FALLBACK = False
+# Chromium profile reused by the fallback renderer between runs
+PW_CACHE_DIR = ".pw_cache"
+
+def _remote_font_size():
+    # HEAD the font URL so we can tell whether the local copy is current
+    req = urllib.request.Request(FONT_URL, method='HEAD')
+    with urllib.request.urlopen(req, timeout=FONT_TIMEOUT) as r:
+        length = r.headers.get('Content-Length')
+    return int(length) if length else None
 
 def download_font():
-    if not os.path.exists(FONT_FILENAME):
-        print(f"Downloading font from {FONT_URL}...")
+    have_font = os.path.exists(FONT_FILENAME)
+    if have_font:
         try:
-            os.system(f"curl -L -o {FONT_FILENAME} {FONT_URL}")
-            print("Font downloaded.")
+            if _remote_font_size() in (None, os.path.getsize(FONT_FILENAME)):
+                return
         except Exception as e:
-            print(f"Error downloading font: {e}")
+            # Offline: keep using the copy we already have
+            print(f"Could not check font for updates: {e}")
+            return
+
+    print(f"Downloading font from {FONT_URL}...")
+    # Download next to the font and swap it in only once complete, so a
+    # failed update never clobbers a working copy
+    tmp_filename = f"{FONT_FILENAME}.part"
+    try:
+        req = urllib.request.Request(FONT_URL)
+        with urllib.request.urlopen(req, timeout=FONT_TIMEOUT) as r, open(tmp_filename, 'wb') as f:
+            shutil.copyfileobj(r, f, 1 << 20)
+        os.replace(tmp_filename, FONT_FILENAME)
+        print("Font downloaded.")
+    except Exception as e:
+        print(f"Error downloading font: {e}")
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        if not have_font:
             exit(1)
+        print("Keeping the existing font.")
+
+def register_font():
+    # Embed the TTF once so every overlay can draw text with it directly
+    pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_FILENAME))
 
-def create_text_image_playwright(text, font_path, font_size, color):
+def shaping_available():
+    # drawString(shaping=True) silently draws unshaped code points unless
+    # rlbidi is importable and the font is shapable (needs uharfbuzz)
+    return bool(textobject.rtlSupport and pdfmetrics.getFont(FONT_NAME).shapable)
+
+def render_text_images(names, font_path, font_size, color):
+    # Inline the font as a data: URI so Chromium never has to fetch it from disk
+    with open(font_path, 'rb') as f:
+        font_b64 = base64.b64encode(f.read()).decode('ascii')
+
+    # One element per name so a single navigation renders the whole batch
+    divs = "\n".join(
+        f'<div><div id="n_{i}" class="text">{html.escape(name)}</div></div>'
+        for i, name in enumerate(names)
+    )
+    html_content = f"""
+    <html>
+    <head>
+        <style>
+            @font-face {{
+                font-family: 'GujaratiFont';
+                src: url('data:font/ttf;base64,{font_b64}') format('truetype');
+            }}
+            body {{
+                margin: 0;
+                padding: 0;
+                background: transparent;
+            }}
+            .text {{
+                font-family: 'GujaratiFont', sans-serif;
+                font-size: {font_size * 4}px; /* High res for quality */
+                color: {color};
+                font-weight: bold;
+                display: inline-block;
+                white-space: nowrap;
+                padding: 5px; /* Padding to avoid clipping */
+            }}
+        </style>
+    </head>
+    <body>
+        {divs}
+    </body>
+    </html>
+    """
+
+    images = []
     with sync_playwright() as p:
-        browser = p.chromium.launch()
-        page = browser.new_page()
-        
-        # Absolute path for font file to ensure browser can load it
-        abs_font_path = os.path.abspath(font_path)
-        
-        # Create HTML with embedded font
-        html_content = f"""
-        <html>
-        <head>
-            <style>
-                @font-face {{
-                    font-family: 'GujaratiFont';
-                    src: url('file://{abs_font_path}') format('truetype');
-                }}
-                body {{
-                    margin: 0;
-                    padding: 0;
-                    background: transparent;
-                }}
-                .text {{
-                    font-family: 'GujaratiFont', sans-serif;
-                    font-size: {font_size * 4}px; /* High res for quality */
-                    color: {color};
-                    font-weight: bold;
-                    display: inline-block;
-                    white-space: nowrap;
-                    padding: 5px; /* Padding to avoid clipping */
-                }}
-            </style>
-        </head>
-        <body>
-            <div id="content" class="text">{text}</div>
-        </body>
-        </html>
-        """
-        
-        page.set_content(html_content)
-        
-        # Get bounding box
-        locator = page.locator('#content')
-        
-        # Take screenshot of the element
-        screenshot_bytes = locator.screenshot(type='png', omit_background=True)
-        
-        browser.close()
-        
-        # Save to temp file
-        temp_img = f"temp_pw_{text}.png"
-        with open(temp_img, "wb") as f:
-            f.write(screenshot_bytes)
-            
-        return temp_img
-
-def create_overlay(text, output_path):
-    c = canvas.Canvas(output_path)
-    
-    # Generate text image using Playwright
+        # Launch Chromium once and screenshot every name from the same page.
+        # A persistent profile keeps Chromium's code and font caches warm across runs.
+        browser = p.chromium.launch_persistent_context(PW_CACHE_DIR, headless=True)
+        try:
+            page = browser.pages[0] if browser.pages else browser.new_page()
+            page.set_content(html_content)
+
+            for i, name in enumerate(names):
+                try:
+                    # Clip a page screenshot to the element's box; the box also
+                    # gives the image size, so nothing has to re-measure the PNG
+                    box = page.locator(f'#n_{i}').bounding_box()
+                    clip = {'x': box['x'], 'y': box['y'], 'width': box['width'], 'height': box['height']}
+                    png_bytes = page.screenshot(type='png', clip=clip, full_page=True, omit_background=True)
+                    images.append((png_bytes, box['width'], box['height']))
+                except Exception as e:
+                    print(f"Error in Playwright rendering for {name}: {e}")
+                    images.append(None)
+        finally:
+            browser.close()
+
+    return images
+
+def create_overlay(text, fp):
+    c = canvas.Canvas(fp)
+
+    # Draw the name as vector text, shaped by HarfBuzz for Gujarati conjuncts
+    c.setFont(FONT_NAME, FONT_SIZE)
+    c.setFillColor(red)
+    c.drawString(X_COORD, Y_COORD, text, shaping=True)
+
+    c.save()
+
+def _image_xobject(pdf, png_bytes):
+    # Split the RGBA screenshot into an RGB image plus a soft mask for the alpha
+    # (a PNG can't be embedded as-is, so Pillow still decodes the pixels).
+    # Streams are left unfiltered; pikepdf compresses them on save.
+    img = Image.open(io.BytesIO(png_bytes)).convert('RGBA')
+    pix_w, pix_h = img.size
+
+    def image_stream(data, color_space, **extra):
+        return pikepdf.Stream(
+            pdf, data,
+            Type=Name.XObject,
+            Subtype=Name.Image,
+            Width=pix_w,
+            Height=pix_h,
+            ColorSpace=color_space,
+            BitsPerComponent=8,
+            **extra,
+        )
+
+    smask = image_stream(img.getchannel('A').tobytes(), Name.DeviceGray)
+    return image_stream(img.convert('RGB').tobytes(), Name.DeviceRGB, SMask=smask)
+
+def stamp_image(pdf, page, image):
+    # Paint the Playwright screenshot straight into the page's content stream,
+    # without building and merging a separate overlay PDF
+    png_bytes, box_w, box_h = image
+    image_name = page.add_resource(_image_xobject(pdf, png_bytes), Name.XObject, prefix='OverlayImg')
+
+    # Scale back down. We rendered at 4x font size.
+    # But we also need to convert pixels to points.
+    # Browser 1px ~ 1/96 inch? Or just relative.
+    # We set font-size: {font_size * 4}px.
+    # We want it to be {font_size} points on PDF.
+    # 1 point = 1/72 inch.
+    # If we assume browser px is roughly equivalent to points for sizing logic (it's not exactly, but close enough for web-to-print often),
+    # we rendered at 4x. So we scale by 0.25.
+    # Let's refine:
+    # We want final height on PDF to be roughly FONT_SIZE points.
+    # The image height includes some padding.
+    # Let's just scale by 0.25 (since we multiplied by 4).
+
+    scale = 0.25
+    pdf_w = box_w * scale
+    pdf_h = box_h * scale
+
+    # Draw image
+    # Y_COORD is where we want the text baseline roughly.
+    # Image includes padding.
+    # Let's center it vertically on Y_COORD or just place it.
+    # User provided specific coordinates, likely for baseline or top-left.
+    # Let's assume baseline-ish.
+    # Wrap the original content in q/Q so its graphics state can't shift the image
+    page.contents_add(b"q\n", prepend=True)
+    page.contents_add(f"Q\nq {pdf_w} 0 0 {pdf_h} {X_COORD} {Y_COORD} cm {image_name} Do Q\n".encode())
+
+# Parsed template, set up once per process by _init_worker
+_template = None
+
+def _init_worker(base_pdf_bytes):
+    global _template
+    register_font()
+    _template = pikepdf.open(io.BytesIO(base_pdf_bytes))
+
+def _render_one(name, image=None):
+    print(f"Processing: {name}")
+
+    output_filename = f"{name}.pdf"
+
     try:
-        img_path = create_text_image_playwright(text, FONT_FILENAME, FONT_SIZE, TEXT_COLOR)
-        
-        if img_path and os.path.exists(img_path):
-            img = Image.open(img_path)
-            pix_w, pix_h = img.size
-            
-            # Scale back down. We rendered at 4x font size.
-            # But we also need to convert pixels to points.
-            # Browser 1px ~ 1/96 inch? Or just relative.
-            # We set font-size: {font_size * 4}px.
-            # We want it to be {font_size} points on PDF.
-            # 1 point = 1/72 inch.
-            # If we assume browser px is roughly equivalent to points for sizing logic (it's not exactly, but close enough for web-to-print often),
-            # we rendered at 4x. So we scale by 0.25.
-            # Let's refine:
-            # We want final height on PDF to be roughly FONT_SIZE points.
-            # The image height includes some padding.
-            # Let's just scale by 0.25 (since we multiplied by 4).
-            
-            scale = 0.25
-            pdf_w = pix_w * scale
-            pdf_h = pix_h * scale
-            
-            # Draw image
-            # Y_COORD is where we want the text baseline roughly.
-            # Image includes padding.
-            # Let's center it vertically on Y_COORD or just place it.
-            # User provided specific coordinates, likely for baseline or top-left.
-            # Let's assume baseline-ish.
-            c.drawImage(img_path, X_COORD, Y_COORD, width=pdf_w, height=pdf_h, mask='auto')
-            
-            os.remove(img_path)
-        else:
-            print("Failed to generate image with Playwright")
+        # Copy the template pages into a new document; drawing onto the copy
+        # never touches the shared template
+        with pikepdf.new() as pdf:
+            pdf.pages.extend(_template.pages)
+
+            if image is None:
+                # Build the overlay in memory; it never touches the disk
+                buf = io.BytesIO()
+                create_overlay(name, buf)
+                buf.seek(0)
+                with pikepdf.open(buf) as overlay:
+                    if len(overlay.pages) > 0:
+                        # Place the overlay at its own size, as merge_page did,
+                        # rather than scaling it to fit the template page
+                        overlay_page = overlay.pages[0]
+                        pdf.pages[0].add_overlay(overlay_page, pikepdf.Rectangle(overlay_page.mediabox))
+            else:
+                stamp_image(pdf, pdf.pages[0], image)
+
+            pdf.save(output_filename)
+
+        print(f"Saved: {output_filename}")
+
     except Exception as e:
-        print(f"Error in Playwright rendering: {e}")
-            
-    c.save()
+        print(f"Error processing {name}: {e}")
 
-def process_pdfs():
+def process_pdfs(jobs=None):
     if not os.path.exists(INPUT_PDF):
         print(f"Error: {INPUT_PDF} not found.")
         return
@@ -138,50 +263,67 @@ def process_pdfs():
         print(f"Error: {CSV_FILE} not found.")
         return
 
-    with open(CSV_FILE, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        
-        if 'name' not in reader.fieldnames:
+    with open(CSV_FILE, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = [col.strip() for col in next(reader, [])]
+
+        if 'name' not in header:
             print("Error: CSV must have a 'name' column.")
             return
 
-        for row in reader:
-            name = row['name']
-            if not name:
-                continue
-            
-            print(f"Processing: {name}")
-            
-            overlay_filename = f"temp_{name}.pdf"
-            output_filename = f"{name}.pdf"
-            
-            try:
-                create_overlay(name, overlay_filename)
-                
-                reader_base = PdfReader(INPUT_PDF)
-                reader_overlay = PdfReader(overlay_filename)
-                writer = PdfWriter()
-                
-                page = reader_base.pages[0]
-                if len(reader_overlay.pages) > 0:
-                    page.merge_page(reader_overlay.pages[0])
-                
-                writer.add_page(page)
-                
-                for i in range(1, len(reader_base.pages)):
-                    writer.add_page(reader_base.pages[i])
-                
-                with open(output_filename, "wb") as out_f:
-                    writer.write(out_f)
-                
-                print(f"Saved: {output_filename}")
-                
-            except Exception as e:
-                print(f"Error processing {name}: {e}")
-            finally:
-                if os.path.exists(overlay_filename):
-                    os.remove(overlay_filename)
+        # Resolve the column once, then strip and filter in a single pass
+        name_idx = header.index('name')
+        names = [name for name in (row[name_idx].strip() for row in reader if len(row) > name_idx) if name]
+
+    # Repeated names (common with family invitations) map to the same output
+    # file, so render each unique name once, keeping CSV order
+    names = list(dict.fromkeys(names))
+    if not names:
+        print("No names found in CSV.")
+        return
+
+    # Read the template once; each process parses it once instead of once per row
+    with open(INPUT_PDF, 'rb') as f:
+        base_bytes = f.read()
+
+    use_browser = USE_BROWSER_FALLBACK
+    if not use_browser and not shaping_available():
+        print("Warning: ReportLab can't shape Gujarati text here (needs both rlbidi and uharfbuzz); "
+              "rendering names with Chromium instead.")
+        use_browser = True
+
+    images = repeat(None)
+    if use_browser:
+        # Rasterize every name up front in one browser page, then drop the failures
+        rendered = render_text_images(names, FONT_FILENAME, FONT_SIZE, TEXT_COLOR)
+        pairs = [(name, image) for name, image in zip(names, rendered) if image]
+        names = [name for name, _ in pairs]
+        images = [image for _, image in pairs]
+
+    # Each row is independent, so fan them out across worker processes. Every
+    # worker parses the template on start-up, so never start more than there
+    # are rows to render.
+    workers = min(jobs or os.cpu_count() or 1, len(names))
+    if not workers:
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(base_bytes,)) as ex:
+        list(ex.map(_render_one, names, images))
+
+def _positive_int(value):
+    # argparse type for --jobs: the pool needs at least one worker
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return jobs
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stamp each name from the CSV onto the kankotri PDF.")
+    parser.add_argument('--jobs', type=_positive_int, default=None,
+                        help="Number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
     download_font()
-    process_pdfs()
+    register_font()
+    process_pdfs(args.jobs)
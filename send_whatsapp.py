@@ -1,20 +1,61 @@
 import csv
+import functools
 import os
+import queue
+import random
 import time
 import re
+import threading
+import uuid
+import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
 from playwright.sync_api import sync_playwright
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Configuration
 CSV_FILE = "name.csv"
 API_URL = "http://localhost:5001/api/logs"
 COUNTRY_CODE = "+91"
 OUTPUT_BASE_DIR = os.path.join(os.getcwd(), "server", "output")
+# Pause after each send to avoid spam detection, in seconds (min, max)
+SEND_DELAY = (2, 4)
+# Per-attempt timeout for retried clicks, in milliseconds. Playwright's own
+# 30 s auto-wait would make each retry very slow.
+CLICK_TIMEOUT = 5000
+# How long a PDF may take to upload after pressing Send, in milliseconds
+UPLOAD_TIMEOUT = 120000
+
+def retry(tries=3, base=0.5):
+    # Retry a flaky call with jittered exponential backoff, re-raising the
+    # last error
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(tries):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    if attempt == tries - 1:
+                        raise
+                    time.sleep(base * 2 ** attempt + random.random() * 0.1)
+        return wrapper
+    return deco
+
+class _DigitsOnly(dict):
+    # str.translate table that drops anything \D would match, filled per code point on first use
+    def __missing__(self, codepoint):
+        value = codepoint if chr(codepoint).isdecimal() else None
+        self[codepoint] = value
+        return value
+
+_DIGITS_TBL = _DigitsOnly()
+# Characters the backend replaces when naming PDFs
+_ILLEGAL_RE = re.compile(r'[<>:"/\\|?*]+')
 
 def clean_phone_number(phone):
     # Remove non-numeric characters
-    digits = re.sub(r'\D', '', str(phone))
+    digits = str(phone).translate(_DIGITS_TBL)
     
     if len(digits) < 10:
         return None
@@ -24,68 +65,187 @@ def clean_phone_number(phone):
     
     return f"{COUNTRY_CODE}{core_number}"
 
-def log_status(name, number, status, message=""):
-    timestamp = datetime.now().isoformat()
-    print(f"[{status}] {name} ({number}): {message}")
-    
-    # Log to Backend API
+# Status logs are posted in batches by a background thread over one
+# keep-alive connection, so the send loop never waits on the API
+LOG_BATCH_SIZE = 32
+# Seconds to wait on the API per batch, so a hung server can't block exit
+LOG_POST_TIMEOUT = 10
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+log_queue = queue.Queue()
+
+@retry(tries=3, base=0.5)
+def _post_batch(payload):
+    session.post(f"{API_URL}/bulk", json=payload, timeout=LOG_POST_TIMEOUT).raise_for_status()
+
+def _post_logs(batch):
+    # The batch id stays the same across retries; the server skips a batch it
+    # has already stored, so a lost response can't duplicate the logs
+    payload = {"batchId": uuid.uuid4().hex, "logs": batch}
     try:
-        requests.post(API_URL, json={
-            "name": name,
-            "number": number,
-            "status": status,
-            "message": message
-        })
+        _post_batch(payload)
     except Exception as e:
         print(f"Failed to log to API: {e}")
 
+def _log_worker():
+    while True:
+        batch = [log_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        _post_logs(batch)
+        for _ in batch:
+            log_queue.task_done()
+
+def start_log_worker():
+    threading.Thread(target=_log_worker, daemon=True).start()
+
+def flush_logs():
+    # Block until every queued log has been posted
+    log_queue.join()
+
+def log_status(name, number, status, message=""):
+    # UTC in the same shape as the server's toISOString(), so logs sort together
+    timestamp = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+    print(f"[{status}] {name} ({number}): {message}")
+    
+    # Queue for the Backend API; the timestamp is kept since posting is deferred
+    log_queue.put({
+        "timestamp": timestamp,
+        "name": name,
+        "number": number,
+        "status": status,
+        "message": message
+    })
+
 def get_safe_filename(name):
     # Match the backend's sanitization logic: replace illegal chars with _
-    return re.sub(r'[<>:"/\\|?*]+', '_', name).strip()
+    return _ILLEGAL_RE.sub('_', name).strip()
 
-def send_whatsapp_messages():
-    if not os.path.exists(CSV_FILE):
-        print(f"Error: {CSV_FILE} not found.")
-        return
+def iter_tasks(reader, name_idx, number_idx):
+    # Yield (name, raw_number) per row, skipping rows without a name
+    for row in reader:
+        name = row[name_idx].strip() if len(row) > name_idx else ""
+        if not name:
+            continue
+        raw_number = row[number_idx].strip() if len(row) > number_idx else ""
+        yield name, raw_number
 
-    # Ask for Client Name to find the correct folder
-    client_name = input("Enter Client Name (folder name in server/output): ").strip()
-    client_folder = os.path.join(OUTPUT_BASE_DIR, client_name)
-    
-    if not os.path.exists(client_folder):
-        print(f"Error: Client folder not found at {client_folder}")
-        return
+def _file_key(filename):
+    # macOS and Windows match filenames case- and normalization-insensitively,
+    # so compare on a key that ignores both
+    return unicodedata.normalize('NFC', filename).casefold()
 
-    # Read CSV data
-    tasks = []
-    with open(CSV_FILE, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        reader.fieldnames = [name.strip() for name in reader.fieldnames]
-        
-        if 'name' not in reader.fieldnames or 'number' not in reader.fieldnames:
-            print("Error: CSV must have 'name' and 'number' columns.")
-            return
+def _index_folder(folder):
+    # Returns (exact filenames, key -> filename). A key shared by several
+    # files maps to None: picking one could send a guest someone else's PDF
+    exact_files, files_by_key = set(), {}
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            exact_files.add(entry.name)
+            key = _file_key(entry.name)
+            files_by_key[key] = None if key in files_by_key else entry.name
+    return exact_files, files_by_key
 
-        for row in reader:
-            name = row.get('name')
-            raw_number = row.get('number')
-            
-            if name: name = name.strip()
-            if raw_number: raw_number = raw_number.strip()
-            else: raw_number = ""
-            
-            if not name: continue
-                
-            tasks.append({'name': name, 'raw_number': raw_number})
+def _prevalidate(name, raw_number, client_folder, exact_files, files_by_key):
+    # Returns (name, formatted_number, pdf_path) for a deliverable row, or None
+    # after logging why it can't be sent
+    # 1. Validate Number
+    formatted_number = clean_phone_number(raw_number)
+    if not formatted_number:
+        log_status(name, raw_number, "FAILED", "Invalid phone number")
+        return None
 
-    if not tasks:
-        print("No tasks found in CSV.")
-        return
+    # 2. Check PDF existence: the exact name first, then the insensitive key
+    safe_name = get_safe_filename(name)
+    pdf_filename = f"{safe_name}.pdf"
+    if pdf_filename not in exact_files:
+        pdf_filename = files_by_key.get(_file_key(pdf_filename)) or pdf_filename
+    pdf_path = os.path.join(client_folder, pdf_filename)
+
+    # Fall back to a stat on a miss or an ambiguous key, in case the
+    # filesystem matches names in some way the key doesn't capture
+    if pdf_filename not in exact_files and not os.path.exists(pdf_path):
+        log_status(name, formatted_number, "FAILED", f"PDF not found: {pdf_path}")
+        return None
+
+    return name, formatted_number, pdf_path
+
+def send_one(page, name, formatted_number, pdf_path):
+    try:
+        print(f"Sending to {name} ({formatted_number})...")
+
+        # Navigate to chat
+        page.goto(f"https://web.whatsapp.com/send?phone={formatted_number[1:]}&text=Here is your invitation")
+
+        # Wait for chat to load
+        try:
+            page.wait_for_selector('div[role="textbox"][contenteditable="true"]', timeout=30000)
+        except:
+            if page.locator("text=Phone number shared via url is invalid").is_visible():
+                log_status(name, formatted_number, "FAILED", "Number not on WhatsApp")
+                return
+            else:
+                log_status(name, formatted_number, "FAILED", "Chat load timeout")
+                return
+
+        # 3. Attach PDF
+        # Click Attach button (Plus icon)
+        attach_btn = page.locator('div[title="Attach"], button[aria-label="Attach"]')
+        attach_btn.wait_for(state="visible", timeout=10000)
+        retry(tries=2, base=1.0)(attach_btn.click)(timeout=CLICK_TIMEOUT)
 
+        # Wait for the menu to appear
+        # We use :visible pseudo-class to ensure we don't pick a hidden "Document" span
+        document_btn = page.locator('span:has-text("Document"):visible, [aria-label="Document"]:visible').first
+        document_btn.wait_for(state="visible", timeout=10000)
+
+        # Handle file chooser
+        with page.expect_file_chooser() as fc_info:
+            retry(tries=2, base=1.0)(document_btn.click)(timeout=CLICK_TIMEOUT)
+
+        # Hand over the path; Playwright passes it to the local browser as-is,
+        # so there is nothing worth reading ahead
+        file_chooser = fc_info.value
+        file_chooser.set_files(pdf_path)
+
+        # 4. Send
+        # Wait for the attachment preview to finish processing: its send
+        # icon only shows once the PDF is ready, so no fixed sleep is needed.
+        page.wait_for_selector('div[role="dialog"] [data-icon="send"]', state="visible", timeout=30000)
+
+        # Note how many outgoing bubbles the chat has, so we can spot ours
+        outgoing = page.locator('div.message-out')
+        sent_before = outgoing.count()
+
+        send_btn = page.locator('div[aria-label="Send"]')
+        send_btn.click()
+
+        # Wait for message to be sent: first our bubble has to show up in the
+        # chat, then its pending clock icon has to go away. The PDF uploads in
+        # between, so that wait is sized for the upload.
+        page.wait_for_function(
+            'n => document.querySelectorAll("div.message-out").length > n',
+            arg=sent_before, timeout=30000
+        )
+        outgoing.last.locator('[data-icon="msg-time"]').wait_for(state="detached", timeout=UPLOAD_TIMEOUT)
+
+        log_status(name, formatted_number, "SUCCESS", "Message sent")
+
+        # Jittered delay to avoid spam detection
+        time.sleep(random.uniform(*SEND_DELAY))
+
+    except Exception as e:
+        log_status(name, formatted_number, "ERROR", str(e))
+
+def run_tasks(tasks):
     # Use a local session directory to avoid conflicts with your open Chrome browser.
     # This requires scanning the QR code ONCE, but allows you to keep your main Chrome open.
     user_data_dir = os.path.join(os.getcwd(), "whatsapp_session")
-    
+
     with sync_playwright() as p:
         try:
             # Launch persistent context
@@ -100,12 +260,12 @@ def send_whatsapp_messages():
         except Exception as e:
             print(f"Error launching browser: {e}")
             return
-        
+
         page = browser.pages[0]
-        
+
         print("Opening WhatsApp Web...")
         page.goto("https://web.whatsapp.com")
-        
+
         # Wait for login
         try:
             page.wait_for_selector('div[role="textbox"]', timeout=60000)
@@ -115,87 +275,56 @@ def send_whatsapp_messages():
             # We continue anyway in case it's just a slow load, but usually this means not logged in
             # or selector changed.
 
+        # One tab only: WhatsApp Web keeps a single tab active per session,
+        # and every /send navigation reloads the app
         for task in tasks:
-            name = task['name']
-            raw_number = task['raw_number']
-            
-            # 1. Validate Number
-            formatted_number = clean_phone_number(raw_number)
-            if not formatted_number:
-                log_status(name, raw_number, "FAILED", "Invalid phone number")
-                continue
-            
-            # 2. Check PDF existence
-            safe_name = get_safe_filename(name)
-            pdf_path = os.path.join(client_folder, f"{safe_name}.pdf")
-            
-            if not os.path.exists(pdf_path):
-                log_status(name, formatted_number, "FAILED", f"PDF not found: {pdf_path}")
-                continue
-            
-            try:
-                print(f"Sending to {name} ({formatted_number})...")
-                
-                # Navigate to chat
-                page.goto(f"https://web.whatsapp.com/send?phone={formatted_number[1:]}&text=Here is your invitation")
-                
-                # Wait for chat to load
-                try:
-                    page.wait_for_selector('div[role="textbox"][contenteditable="true"]', timeout=30000)
-                except:
-                    if page.locator("text=Phone number shared via url is invalid").is_visible():
-                        log_status(name, formatted_number, "FAILED", "Number not on WhatsApp")
-                        continue
-                    else:
-                        log_status(name, formatted_number, "FAILED", "Chat load timeout")
-                        continue
-
-                # 3. Attach PDF
-                # Click Attach button (Plus icon)
-                attach_btn = page.locator('div[title="Attach"], button[aria-label="Attach"]')
-                attach_btn.wait_for(state="visible", timeout=10000)
-                attach_btn.click()
-                
-                # Wait for the menu to appear
-                # We use :visible pseudo-class to ensure we don't pick a hidden "Document" span
-                document_btn = page.locator('span:has-text("Document"):visible, [aria-label="Document"]:visible').first
-                document_btn.wait_for(state="visible", timeout=10000)
-                
-                # Handle file chooser
-                with page.expect_file_chooser() as fc_info:
-                    document_btn.click()
-                
-                file_chooser = fc_info.value
-                file_chooser.set_files(pdf_path)
-                
-                # 4. Send
-                # Wait for the file to be attached and processed.
-                # The send button might be visible but disabled, or not visible yet.
-                # We can also wait for the "Loading..." preview to disappear if possible.
-                
-                # Wait for Send button to be clickable
-                send_btn = page.locator('div[aria-label="Send"]')
-                send_btn.wait_for(state="visible", timeout=30000)
-                
-                # Extra wait to ensure PDF is fully attached (sometimes it takes a second to process)
-                time.sleep(3) 
-                
-                send_btn.click()
-                
-                # Wait for message to be sent (tick appears)
-                # We'll just wait a bit longer to be safe
-                time.sleep(5)
-                
-                log_status(name, formatted_number, "SUCCESS", "Message sent")
-                
-                # Delay to avoid spam detection
-                time.sleep(3)
-                
-            except Exception as e:
-                log_status(name, formatted_number, "ERROR", str(e))
-        
+            send_one(page, *task)
+
         print("All tasks completed.")
         # browser.close()
 
+def send_whatsapp_messages():
+    if not os.path.exists(CSV_FILE):
+        print(f"Error: {CSV_FILE} not found.")
+        return
+
+    # Ask for Client Name to find the correct folder
+    client_name = input("Enter Client Name (folder name in server/output): ").strip()
+    client_folder = os.path.join(OUTPUT_BASE_DIR, client_name)
+    
+    if not os.path.exists(client_folder):
+        print(f"Error: Client folder not found at {client_folder}")
+        return
+
+    start_log_worker()
+    try:
+        # List the client folder once instead of stat-ing a path per row
+        exact_files, files_by_key = _index_folder(client_folder)
+
+        # Validate every row up front so the browser only handles deliverable ones
+        with open(CSV_FILE, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            header = [col.strip() for col in next(reader, [])]
+            
+            if 'name' not in header or 'number' not in header:
+                print("Error: CSV must have 'name' and 'number' columns.")
+                return
+
+            tasks = [
+                task for task in (
+                    _prevalidate(name, raw_number, client_folder, exact_files, files_by_key)
+                    for name, raw_number in iter_tasks(reader, header.index('name'), header.index('number'))
+                )
+                if task
+            ]
+
+        if not tasks:
+            print("No deliverable tasks found in CSV.")
+            return
+
+        run_tasks(tasks)
+    finally:
+        flush_logs()
+
 if __name__ == "__main__":
     send_whatsapp_messages()
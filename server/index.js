@@ -309,6 +309,41 @@ app.post('/api/logs', (req, res) => {
     res.json({ success: true });
 });
 
+// Retries happen within seconds, so only the most recent batch ids are kept
+const LOG_BATCH_HISTORY = 1000;
+
+app.post('/api/logs/bulk', (req, res) => {
+    const { batchId, logs } = req.body || {};
+    // Skip anything that isn't a log object rather than failing the batch
+    const entries = (Array.isArray(logs) ? logs : [])
+        .filter(entry => entry && typeof entry === 'object' && !Array.isArray(entry));
+    const db = readDb();
+    if (!db.logs) db.logs = [];
+    if (!db.logBatches) db.logBatches = [];
+
+    // Retried batches reuse their id; don't store the same batch twice
+    if (batchId && db.logBatches.includes(batchId)) {
+        return res.json({ success: true, count: 0, duplicate: true });
+    }
+
+    for (const { timestamp, name, number, status, message } of entries) {
+        db.logs.push({
+            timestamp: timestamp || new Date().toISOString(),
+            name,
+            number,
+            status,
+            message
+        });
+    }
+
+    if (batchId) {
+        db.logBatches.push(batchId);
+        db.logBatches = db.logBatches.slice(-LOG_BATCH_HISTORY);
+    }
+
+    writeDb(db);
+    res.json({ success: true, count: entries.length });
+});
 
 app.use('/uploads', express.static('uploads'));
 